@@ -1,18 +1,30 @@
 #!/usr/bin/env python3
 
 import os
+import asyncio
 import logging
-import json
 import io
+import mmap
+import functools
+import hashlib
 import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
-from flask import Flask, request
+import httpx
+import orjson
+from asgiref.wsgi import WsgiToAsgi
+from flask import Flask
+from hypercorn.asyncio import serve
+from hypercorn.config import Config
 from telegram import Update
+from telegram.error import BadRequest, NetworkError, RetryAfter
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
 
 from google.oauth2 import service_account
+from google_auth_httplib2 import AuthorizedHttp
 from googleapiclient.discovery import build
-from googleapiclient.http import MediaIoBaseUpload
+from googleapiclient.http import HttpRequest, MediaIoBaseUpload, build_http
 from googleapiclient.errors import HttpError
 
 # Configure logging
@@ -26,9 +38,63 @@ logger = logging.getLogger(__name__)
 TELEGRAM_BOT_TOKEN = os.environ.get("TELEGRAM_BOT_TOKEN")
 GOOGLE_DRIVE_FOLDER_ID = os.environ.get("GOOGLE_DRIVE_FOLDER_ID")
 AUTHORIZED_USERS_STR = os.environ.get("AUTHORIZED_USERS", "")
-AUTHORIZED_USERS = [int(user_id) for user_id in AUTHORIZED_USERS_STR.split(",") if user_id]
+AUTHORIZED_USERS = frozenset(int(user_id) for user_id in AUTHORIZED_USERS_STR.split(",") if user_id)
 SCOPES = ['https://www.googleapis.com/auth/drive']
 
+def chunk_size_from_env(name, default_mb, alignment):
+    # Megabytes from the environment, rounded up to a multiple of alignment and
+    # never below 512KB
+    size = int(float(os.environ.get(name, default_mb)) * 1024 * 1024)
+    return max(512 * 1024, -(-size // alignment) * alignment)
+
+# Parallel download tuning (parts are page aligned for the mmap'd temp file)
+DOWNLOAD_PART_SIZE = chunk_size_from_env("DL_CHUNK_MB", 4, mmap.PAGESIZE)
+DOWNLOAD_CONCURRENCY = 4
+DOWNLOAD_MAX_RETRIES = 5
+
+# Drive upload tuning (resumable chunks must be multiples of 256KB)
+SINGLE_SHOT_UPLOAD_LIMIT = 100 * 1024 * 1024
+RESUMABLE_UPLOAD_CHUNK_SIZE = chunk_size_from_env("UL_CHUNK_MB", 16, 256 * 1024)
+logger.info(
+    f"Download part size: {DOWNLOAD_PART_SIZE} bytes, "
+    f"upload chunk size: {RESUMABLE_UPLOAD_CHUNK_SIZE} bytes"
+)
+
+# Socket timeout in seconds for requests to the Drive API
+DRIVE_HTTP_TIMEOUT = 60
+
+# Drive appProperties key holding the Telegram file_unique_id of an upload
+DEDUP_PROPERTY = "telegramFileUniqueId"
+
+# Minimum seconds between edits of a transfer's status message
+PROGRESS_EDIT_INTERVAL = 3.0
+
+# Attempts at editing in a final result before sending it as a new reply
+FINAL_EDIT_ATTEMPTS = 3
+
+# Transfers allowed to run at once across all chats
+MAX_CONCURRENT_UPLOADS = int(os.environ.get("MAX_CONCURRENT_UPLOADS", 3))
+
+# RAM-backed directory used for temp files when it has room for them
+TMPFS_DIR = "/dev/shm"
+
+# Pending transfers and their worker task, per chat
+chat_queues = {}
+chat_workers = {}
+upload_slots = asyncio.Semaphore(MAX_CONCURRENT_UPLOADS)
+# Upload calls block until the download has written the data they read, so they
+# get their own threads: the default executor must stay free for those writes.
+upload_executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_UPLOADS, thread_name_prefix="drive-upload")
+
+# Status message edits waiting for edit_worker: the latest text per
+# (chat_id, message_id), and the order in which those messages were queued
+pending_edits = {}
+edit_keys = asyncio.Queue()
+# Event per message edit_worker is editing right now, set once it is done
+edits_in_flight = {}
+# Messages whose final status is being sent; edit_worker leaves them alone
+finalized_edits = set()
+
 # Flask app for health checks and webhook
 app = Flask(__name__)
 
@@ -40,34 +106,52 @@ def health_check():
 def health():
     return {"status": "healthy", "bot": "running"}
 
-def get_drive_service():
+@functools.lru_cache(maxsize=1)
+def get_drive_credentials():
+    # Parsed once and reused; failures are not cached so the next call retries.
     try:
         service_account_info = os.environ.get("GOOGLE_SERVICE_ACCOUNT")
         if not service_account_info:
             raise Exception("GOOGLE_SERVICE_ACCOUNT environment variable not found")
-        service_account_data = json.loads(service_account_info)
-        credentials = service_account.Credentials.from_service_account_info(
+        service_account_data = orjson.loads(service_account_info)
+        return service_account.Credentials.from_service_account_info(
             service_account_data,
             scopes=SCOPES
         )
-        return build('drive', 'v3', credentials=credentials)
     except Exception as e:
         logger.error(f"Failed to authenticate with Google Drive: {str(e)}")
         raise
 
-async def check_authorization(update: Update):
-    user_id = update.effective_user.id
-    if not AUTHORIZED_USERS:
-        return True
-    if user_id in AUTHORIZED_USERS:
-        return True
-    else:
-        await update.message.reply_text("❌ You are not authorized to use this bot.")
-        return False
+_drive_http = threading.local()
+
+def drive_http():
+    # httplib2 is not thread-safe, so each executor thread gets its own authorized
+    # Http, which keeps its connection to Google alive between requests and chunks.
+    http = getattr(_drive_http, "http", None)
+    if http is None:
+        # build_http stops httplib2 treating Drive's 308 "Resume Incomplete" as a redirect
+        base_http = build_http()
+        base_http.timeout = DRIVE_HTTP_TIMEOUT
+        http = AuthorizedHttp(get_drive_credentials(), http=base_http)
+        _drive_http.http = http
+    return http
+
+@functools.lru_cache(maxsize=1)
+def get_drive_service():
+    # Requests are bound to the Http of the thread that builds them; requests
+    # executed from another thread must pass http=drive_http() explicitly.
+    return build(
+        'drive', 'v3',
+        http=drive_http(),
+        cache_discovery=False,
+        static_discovery=True,
+        requestBuilder=lambda http, *args, **kwargs: HttpRequest(drive_http(), *args, **kwargs)
+    )
+
+async def reject_unauthorized(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.effective_message.reply_text("❌ You are not authorized to use this bot.")
 
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not await check_authorization(update):
-        return
     await update.message.reply_text(
         "🚀 **Welcome to Telegram to Google Drive Bot!**\n\n"
         "📁 Send me any file and I'll upload it to your Google Drive\n"
@@ -77,8 +161,6 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not await check_authorization(update):
-        return
     await update.message.reply_text(
         "📖 **Available Commands:**\n\n"
         "🏁 /start - Start the bot\n"
@@ -89,13 +171,14 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
 async def status_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not await check_authorization(update):
-        return
     status_message = "🤖 **Bot Status Report:**\n\n"
     status_message += "✅ Bot is running smoothly\n"
     try:
         drive_service = get_drive_service()
-        drive_about = drive_service.about().get(fields="storageQuota").execute()
+        # The bot shares its event loop with the web server, keep blocking calls off it
+        drive_about = await asyncio.get_running_loop().run_in_executor(
+            None, lambda: drive_service.about().get(fields="storageQuota").execute()
+        )
         quota = drive_about.get('storageQuota', {})
         used = int(quota.get('usage', 0)) / (1024 ** 3)
         total = int(quota.get('limit', 0)) / (1024 ** 3)
@@ -109,24 +192,393 @@ async def status_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         status_message += f"❌ Google Drive connection error:\n`{str(e)}`"
     await update.message.reply_text(status_message)
 
+_KB, _MB, _GB = 1 << 10, 1 << 20, 1 << 30
+
+# Sliced rather than rebuilt on every progress update (supports widths up to 100)
+_BAR_FILLED = "█" * 100
+_BAR_EMPTY = "░" * 100
+
 def create_progress_bar(progress, width=20):
-    filled = int(width * progress / 100)
-    bar = "█" * filled + "░" * (width - filled)
-    return f"[{bar}] {progress}%"
+    filled = width * progress // 100
+    return f"[{_BAR_FILLED[:filled]}{_BAR_EMPTY[:width - filled]}] {progress}%"
+
+def _format_scaled(size_bytes, unit, suffix):
+    # Two decimals in integer arithmetic, rounding ties to even like "%.2f" does
+    scaled, remainder = divmod(size_bytes * 100, unit)
+    if 2 * remainder > unit or (2 * remainder == unit and scaled % 2):
+        scaled += 1
+    whole, hundredths = divmod(scaled, 100)
+    return f"{whole}.{hundredths:02d}{suffix}"
 
 def format_file_size(size_bytes):
-    if size_bytes >= 1024**3:
-        return f"{size_bytes / (1024**3):.2f}GB"
-    elif size_bytes >= 1024**2:
-        return f"{size_bytes / (1024**2):.2f}MB"
-    elif size_bytes >= 1024:
-        return f"{size_bytes / 1024:.2f}KB"
+    if size_bytes >= _GB:
+        return _format_scaled(size_bytes, _GB, "GB")
+    elif size_bytes >= _MB:
+        return _format_scaled(size_bytes, _MB, "MB")
+    elif size_bytes >= _KB:
+        return _format_scaled(size_bytes, _KB, "KB")
     else:
         return f"{size_bytes}B"
 
+def create_temp_file(file_size):
+    # Returns an open, sized NamedTemporaryFile. tmpfs is preferred while it has
+    # twice the file size free; the space is reserved there up front so concurrent
+    # transfers can't all count on the same free space. Otherwise, or if the
+    # reservation fails, the file goes to the platform default temp directory.
+    try:
+        stats = os.statvfs(TMPFS_DIR)
+    except OSError:
+        stats = None
+    if stats and file_size and stats.f_bavail * stats.f_frsize >= 2 * file_size:
+        temp_file = tempfile.NamedTemporaryFile(delete=False, dir=TMPFS_DIR)
+        try:
+            os.posix_fallocate(temp_file.fileno(), 0, file_size)
+            return temp_file
+        except OSError as e:
+            logger.warning(f"Could not reserve {file_size} bytes in {TMPFS_DIR}: {e}")
+            temp_file.close()
+            os.unlink(temp_file.name)
+    temp_file = tempfile.NamedTemporaryFile(delete=False)
+    temp_file.truncate(file_size)
+    return temp_file
+
+class DownloadStream(io.RawIOBase):
+    # Read-only view of a file that is still being downloaded. Reads block until
+    # the requested range has arrived, so MediaIoBaseUpload (which needs a sized,
+    # seekable stream) can upload from a worker thread while the download runs.
+    # The file behind fd must already be sized; it is memory-mapped so reads are
+    # served from the page cache without a read() syscall per chunk, and the
+    # mapping outlives the caller closing fd.
+    def __init__(self, fd, size):
+        super().__init__()
+        self._mm = None
+        self._view = memoryview(b"")
+        if size:
+            self._mm = mmap.mmap(fd, size, access=mmap.ACCESS_READ)
+            self._view = memoryview(self._mm)
+        self._size = size
+        # Hashes the bytes in the order the uploader reads them, so the digest is
+        # ready once the upload has consumed the file, without a second pass.
+        self._sha256 = hashlib.sha256()
+        self._hashed = 0
+        self._pos = 0
+        self._available = 0
+        self._finished_parts = {}
+        self._error = None
+        self._condition = threading.Condition()
+
+    def mark_downloaded(self, offset, length):
+        with self._condition:
+            self._finished_parts[offset] = length
+            while self._available in self._finished_parts:
+                self._available += self._finished_parts.pop(self._available)
+            self._condition.notify_all()
+
+    def fail(self, error):
+        with self._condition:
+            self._error = error
+            self._condition.notify_all()
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += self._size
+        self._pos = offset
+        return self._pos
+
+    def _wait_until(self, end):
+        with self._condition:
+            self._condition.wait_for(lambda: self._available >= end or self._error)
+            if self._available < end:
+                raise IOError(f"Stream aborted: {self._error}")
+
+    def _hash_through(self, end):
+        if self._pos <= self._hashed < end:
+            self._sha256.update(self._view[self._hashed:end])
+            self._hashed = end
+
+    def hexdigest(self):
+        # SHA-256 of the whole file, or None if it hasn't been read to the end
+        return self._sha256.hexdigest() if self._hashed == self._size else None
+
+    def readinto(self, buffer):
+        end = min(self._pos + len(buffer), self._size)
+        if end <= self._pos:
+            return 0
+        self._wait_until(end)
+        self._hash_through(end)
+        length = end - self._pos
+        buffer[:length] = self._view[self._pos:end]
+        self._pos = end
+        return length
+
+    def read(self, size=-1):
+        end = self._size if size is None or size < 0 else min(self._pos + size, self._size)
+        if end <= self._pos:
+            return b""
+        self._wait_until(end)
+        self._hash_through(end)
+        data = self._mm[self._pos:end]
+        self._pos = end
+        return data
+
+    def close(self):
+        if not self.closed:
+            self._view.release()
+            if self._mm is not None:
+                self._mm.close()
+        super().close()
+
+async def fetch_part(client, url, offset, buffer, length):
+    # Streams the byte range at offset into buffer[:length], reusing the caller's
+    # buffer instead of allocating a fresh bytes object per part.
+    headers = {"Range": f"bytes={offset}-{offset + length - 1}"}
+    for attempt in range(DOWNLOAD_MAX_RETRIES):
+        delay = 2 ** attempt
+        try:
+            async with client.stream("GET", url, headers=headers) as response:
+                if response.status_code == 429:
+                    try:
+                        delay = int(response.headers.get("Retry-After", delay))
+                    except ValueError:
+                        # An HTTP-date rather than seconds; keep the backoff delay
+                        pass
+                    logger.warning(f"Flood wait on part at offset {offset}, sleeping {delay}s")
+                elif response.is_server_error:
+                    logger.warning(
+                        f"Part at offset {offset} got HTTP {response.status_code}, retrying in {delay}s"
+                    )
+                else:
+                    response.raise_for_status()
+                    received = 0
+                    async for chunk in response.aiter_bytes():
+                        if received + len(chunk) > length:
+                            raise RuntimeError("Telegram file server ignored the Range header")
+                        buffer[received:received + len(chunk)] = chunk
+                        received += len(chunk)
+                    if received == length:
+                        return
+                    logger.warning(f"Part at offset {offset} was cut short, retrying in {delay}s")
+        except httpx.TransportError as e:
+            logger.warning(f"Part at offset {offset} failed ({e}), retrying in {delay}s")
+        if attempt < DOWNLOAD_MAX_RETRIES - 1:
+            await asyncio.sleep(delay)
+    raise RuntimeError(f"Giving up on part at offset {offset} after {DOWNLOAD_MAX_RETRIES} attempts")
+
+def pwrite_all(fd, data, offset):
+    # os.pwrite may write less than asked (e.g. a full disk under a sparse file);
+    # finish the part or fail, never report a partly written part as downloaded
+    while data:
+        written = os.pwrite(fd, data, offset)
+        if written == 0:
+            raise OSError(f"Short write at offset {offset}")
+        data = data[written:]
+        offset += written
+
+async def download_telegram_file(telegram_file, file_size, path, progress_queue):
+    # Fetches the file as DOWNLOAD_CONCURRENCY parallel byte-range requests written
+    # straight into place, reporting each finished (offset, length) on progress_queue.
+    # A None on the queue marks the end of the download (successful or not).
+    try:
+        if not telegram_file.file_path.startswith(("http://", "https://")):
+            # Local Bot API server: the file is already on this machine
+            await telegram_file.download_to_drive(path)
+            await progress_queue.put((0, file_size))
+            return
+        loop = asyncio.get_running_loop()
+        part_offsets = iter(range(0, file_size, DOWNLOAD_PART_SIZE))
+        pending_writes = set()
+        fd = os.open(path, os.O_WRONLY)
+        try:
+            os.ftruncate(fd, file_size)
+            async with httpx.AsyncClient(timeout=60) as client:
+                async def download_parts():
+                    buffer = bytearray(DOWNLOAD_PART_SIZE)
+                    view = memoryview(buffer)
+                    for offset in part_offsets:
+                        length = min(DOWNLOAD_PART_SIZE, file_size - offset)
+                        await fetch_part(client, telegram_file.file_path, offset, buffer, length)
+                        # Disk writes go to the executor so a slow disk doesn't stall
+                        # other chats; shielded so a cancelled worker can't leave a
+                        # write running after fd is closed.
+                        write = loop.run_in_executor(None, pwrite_all, fd, view[:length], offset)
+                        pending_writes.add(write)
+                        write.add_done_callback(pending_writes.discard)
+                        await asyncio.shield(write)
+                        await progress_queue.put((offset, length))
+                workers = [asyncio.create_task(download_parts()) for _ in range(DOWNLOAD_CONCURRENCY)]
+                try:
+                    await asyncio.gather(*workers)
+                finally:
+                    for worker in workers:
+                        worker.cancel()
+        finally:
+            if pending_writes:
+                await asyncio.wait(pending_writes)
+            os.close(fd)
+    finally:
+        await progress_queue.put(None)
+
+def queue_status_edit(status_message, text):
+    key = (status_message.chat_id, status_message.message_id)
+    if key not in pending_edits:
+        edit_keys.put_nowait(key)
+    pending_edits[key] = text
+
+async def edit_worker():
+    # The only sender of progress edits: edits queued for the same message while
+    # it waits collapse into the newest text, and flood control pauses all of them.
+    while True:
+        key = await edit_keys.get()
+        text = pending_edits.pop(key, None)
+        if text is None or key in finalized_edits:
+            # Superseded by a final status sent with send_final_status
+            continue
+        done = edits_in_flight[key] = asyncio.Event()
+        chat_id, message_id = key
+        try:
+            await application.bot.edit_message_text(text, chat_id=chat_id, message_id=message_id)
+        except RetryAfter as e:
+            logger.warning(f"Flood control on status edits, retrying in {e.retry_after}s")
+            await asyncio.sleep(e.retry_after)
+            if key not in pending_edits and key not in finalized_edits:
+                edit_keys.put_nowait(key)
+                pending_edits[key] = text
+        except Exception as e:
+            logger.warning(f"Could not edit status message: {e}")
+        finally:
+            del edits_in_flight[key]
+            done.set()
+
+async def send_final_status(status_message, text):
+    # Results must reach the user, so they bypass the coalescing queue: wait out
+    # any progress edit in flight, drop queued ones, retry transient failures and
+    # fall back to a new reply if the edit still can't be made.
+    key = (status_message.chat_id, status_message.message_id)
+    finalized_edits.add(key)
+    try:
+        pending_edits.pop(key, None)
+        while key in edits_in_flight:
+            await edits_in_flight[key].wait()
+        for attempt in range(FINAL_EDIT_ATTEMPTS):
+            try:
+                await status_message.edit_text(text)
+                return
+            except RetryAfter as e:
+                delay = e.retry_after
+                error = e
+            except BadRequest as e:
+                # Permanent, e.g. the message was deleted: retrying won't help
+                error = e
+                break
+            except NetworkError as e:
+                delay = 2 ** attempt
+                error = e
+            if attempt < FINAL_EDIT_ATTEMPTS - 1:
+                logger.warning(f"Could not edit final status ({error}), retrying in {delay}s")
+                await asyncio.sleep(delay)
+        logger.warning(f"Could not edit final status ({error}), replying instead")
+        await status_message.reply_text(text)
+    finally:
+        finalized_edits.discard(key)
+
+async def report_progress(status_message, file_name, file_size, transfer):
+    # Queues a status edit at most once per PROGRESS_EDIT_INTERVAL with both the
+    # download and the upload progress, until cancelled.
+    file_size_formatted = format_file_size(file_size)
+    last_text = None
+    while True:
+        await asyncio.sleep(PROGRESS_EDIT_INTERVAL)
+        downloaded = transfer['downloaded']
+        uploaded = transfer['uploaded']
+        text = (
+            f"🚚 **Transferring to Google Drive**\n\n"
+            f"📥 Download: {create_progress_bar(downloaded * 100 // max(file_size, 1))}\n"
+            f"📊 {format_file_size(downloaded)} / {file_size_formatted}\n\n"
+            f"☁️ Upload: {create_progress_bar(uploaded * 100 // max(file_size, 1))}\n"
+            f"📊 {format_file_size(uploaded)} / {file_size_formatted}\n\n"
+            f"📁 File: {file_name}"
+        )
+        if text != last_text:
+            queue_status_edit(status_message, text)
+            last_text = text
+
+async def find_existing_upload(file_unique_id):
+    # Telegram gives identical content the same file_unique_id, so a match means
+    # this file is already in Drive and neither download nor upload is needed.
+    loop = asyncio.get_running_loop()
+    drive_service = get_drive_service()
+    query = (
+        f"appProperties has {{ key='{DEDUP_PROPERTY}' and value='{file_unique_id}' }}"
+        f" and trashed = false"
+    )
+    if GOOGLE_DRIVE_FOLDER_ID:
+        query += f" and '{GOOGLE_DRIVE_FOLDER_ID}' in parents"
+    result = await loop.run_in_executor(None, lambda: drive_service.files().list(
+        q=query,
+        fields='files(id,webViewLink)',
+        pageSize=1
+    ).execute())
+    files = result.get('files', [])
+    return files[0] if files else None
+
+async def delete_drive_file(file_id):
+    loop = asyncio.get_running_loop()
+    drive_service = get_drive_service()
+    try:
+        await loop.run_in_executor(
+            None, lambda: drive_service.files().delete(fileId=file_id).execute()
+        )
+    except HttpError as error:
+        logger.error(f"Could not delete Drive file {file_id}: {error}")
+
+async def upload_to_drive(stream, file_name, file_size, file_unique_id, transfer):
+    loop = asyncio.get_running_loop()
+    drive_service = get_drive_service()
+    file_metadata = {
+        'name': file_name,
+        'parents': [GOOGLE_DRIVE_FOLDER_ID] if GOOGLE_DRIVE_FOLDER_ID else [],
+        'appProperties': {DEDUP_PROPERTY: file_unique_id}
+    }
+    # Small files go up in a single request; large ones use big resumable chunks
+    # so each HTTP round-trip carries more data.
+    resumable = file_size >= SINGLE_SHOT_UPLOAD_LIMIT
+    media = MediaIoBaseUpload(
+        stream,
+        mimetype='application/octet-stream',
+        chunksize=RESUMABLE_UPLOAD_CHUNK_SIZE if resumable else -1,
+        resumable=resumable
+    )
+    # A non-resumable request reads the whole body while being built, which waits
+    # on the download, so build it off the event loop too.
+    request = await loop.run_in_executor(upload_executor, lambda: drive_service.files().create(
+        body=file_metadata,
+        media_body=media,
+        fields='id,webViewLink,size,sha256Checksum'
+    ))
+    if not resumable:
+        return await loop.run_in_executor(upload_executor, lambda: request.execute(http=drive_http()))
+    response = None
+    while response is None:
+        # next_chunk blocks on the network and on the download, keep it off the event loop
+        status, response = await loop.run_in_executor(
+            upload_executor, lambda: request.next_chunk(http=drive_http())
+        )
+        if status:
+            transfer['uploaded'] = status.resumable_progress
+    return response
+
 async def handle_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not await check_authorization(update):
-        return
     if not update.message.document:
         await update.message.reply_text("❌ Please send a file document.")
         return
@@ -150,73 +602,102 @@ async def handle_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"📏 Size: {file_size_formatted}\n\n"
         f"⏳ Starting download from Telegram..."
     )
+    # Transfers run on a per-chat worker so this handler returns right away and
+    # other chats keep being served; files from one chat are handled in order.
+    chat_id = update.effective_chat.id
+    chat_queues.setdefault(chat_id, asyncio.Queue()).put_nowait((update, context))
+    if chat_id not in chat_workers:
+        chat_workers[chat_id] = asyncio.create_task(chat_worker(chat_id))
+
+async def chat_worker(chat_id):
+    queue = chat_queues[chat_id]
+    try:
+        while not queue.empty():
+            update, context = queue.get_nowait()
+            try:
+                async with upload_slots:
+                    await process_file(update, context)
+            except Exception as e:
+                logger.error(f"File transfer for chat {chat_id} failed: {e}")
+    finally:
+        del chat_queues[chat_id]
+        del chat_workers[chat_id]
+
+async def process_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    file = update.message.document
+    file_name = file.file_name or "unnamed_file"
+    file_size = file.file_size
+    file_size_formatted = format_file_size(file_size)
     try:
         status_message = await update.message.reply_text("📥 Preparing download...")
+        try:
+            existing = await find_existing_upload(file.file_unique_id)
+        except Exception as e:
+            # The lookup only saves work; if it fails, upload as usual
+            logger.warning(f"Duplicate check failed, uploading anyway: {e}")
+            existing = None
+        if existing:
+            await send_final_status(
+                status_message,
+                f"♻️ **Already in Google Drive!**\n\n"
+                f"📁 **File:** `{file_name}`\n"
+                f"📏 **Size:** {file_size_formatted}\n"
+                f"🆔 **Drive ID:** `{existing.get('id')}`\n\n"
+                f"🔗 **[Open in Google Drive]({existing.get('webViewLink', 'Link not available')})**"
+            )
+            return
         telegram_file = await context.bot.get_file(file.file_id)
-        with tempfile.NamedTemporaryFile(delete=False) as temp_file:
+        with create_temp_file(file_size) as temp_file:
             temp_file_path = temp_file.name
-        chunk_size = 1 * 1024 * 1024
-        downloaded_size = 0
-        last_progress_update = -1
-        with open(temp_file_path, 'wb') as f:
-            async for chunk in telegram_file.download_chunk(chunk_size=chunk_size):
-                f.write(chunk)
-                downloaded_size += len(chunk)
-                progress = min(int((downloaded_size / file_size) * 100), 100)
-                if progress - last_progress_update >= 3:
-                    progress_bar = create_progress_bar(progress)
-                    downloaded_formatted = format_file_size(downloaded_size)
-                    await status_message.edit_text(
-                        f"📥 **Downloading from Telegram**\n\n"
-                        f"{progress_bar}\n\n"
-                        f"📊 Progress: {downloaded_formatted} / {file_size_formatted}\n"
-                        f"⚡ Status: {progress}% complete"
-                    )
-                    last_progress_update = progress
-        await status_message.edit_text(
-            f"✅ **Download Complete!**\n\n"
-            f"☁️ Starting upload to Google Drive...\n"
-            f"📁 File: {file_name}"
+            # The upload reads from the temp file as soon as each byte range lands,
+            # so Drive receives data while Telegram is still sending the rest.
+            stream = DownloadStream(temp_file.fileno(), file_size)
+        progress_queue = asyncio.Queue()
+        download = asyncio.create_task(
+            download_telegram_file(telegram_file, file_size, temp_file_path, progress_queue)
+        )
+        transfer = {'downloaded': 0, 'uploaded': 0}
+        upload = asyncio.create_task(
+            upload_to_drive(stream, file_name, file_size, file.file_unique_id, transfer)
         )
+        reporter = asyncio.create_task(report_progress(status_message, file_name, file_size, transfer))
         try:
-            drive_service = get_drive_service()
-            file_metadata = {
-                'name': file_name,
-                'parents': [GOOGLE_DRIVE_FOLDER_ID] if GOOGLE_DRIVE_FOLDER_ID else []
-            }
-            chunk_size_upload = 2 * 1024 * 1024
-            media = MediaIoBaseUpload(
-                io.FileIO(temp_file_path, 'rb'),
-                mimetype='application/octet-stream',
-                chunksize=chunk_size_upload,
-                resumable=True
-            )
-            request = drive_service.files().create(
-                body=file_metadata,
-                media_body=media,
-                fields='id,webViewLink,size'
-            )
-            response = None
-            last_upload_progress = -1
-            while response is None:
-                status, response = request.next_chunk()
-                if status:
-                    progress = int(status.progress() * 100)
-                    uploaded_size = int(file_size * status.progress())
-                    if progress - last_upload_progress >= 5:
-                        progress_bar = create_progress_bar(progress)
-                        uploaded_formatted = format_file_size(uploaded_size)
-                        await status_message.edit_text(
-                            f"☁️ **Uploading to Google Drive**\n\n"
-                            f"{progress_bar}\n\n"
-                            f"📊 Progress: {uploaded_formatted} / {file_size_formatted}\n"
-                            f"⚡ Status: {progress}% complete\n"
-                            f"📁 File: {file_name}"
-                        )
-                        last_upload_progress = progress
+            # Watch the upload alongside the download so an upload that fails early
+            # (quota, auth) stops the transfer instead of waiting for the whole file.
+            download_finished = False
+            next_part = asyncio.create_task(progress_queue.get())
+            try:
+                while True:
+                    await asyncio.wait({next_part, upload}, return_when=asyncio.FIRST_COMPLETED)
+                    if upload.done() and not next_part.done():
+                        break
+                    part = next_part.result()
+                    if part is None:
+                        download_finished = True
+                        break
+                    offset, length = part
+                    stream.mark_downloaded(offset, length)
+                    transfer['downloaded'] += length
+                    next_part = asyncio.create_task(progress_queue.get())
+            finally:
+                next_part.cancel()
+            if download_finished:
+                await download
+            response = await upload
+            drive_checksum = response.get('sha256Checksum')
+            local_checksum = stream.hexdigest()
+            if drive_checksum and local_checksum and drive_checksum != local_checksum:
+                # Remove the corrupt copy, or its dedup tag would keep answering
+                # "already in Drive" for this document
+                await delete_drive_file(response.get('id'))
+                raise IOError(
+                    f"Checksum mismatch: sent {local_checksum}, Drive stored {drive_checksum}"
+                )
             file_id = response.get('id')
             file_link = response.get('webViewLink', 'Link not available')
-            await status_message.edit_text(
+            reporter.cancel()
+            await send_final_status(
+                status_message,
                 f"🎉 **Upload Successful!**\n\n"
                 f"📁 **File:** `{file_name}`\n"
                 f"📏 **Size:** {file_size_formatted}\n"
@@ -226,7 +707,9 @@ async def handle_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
         except HttpError as error:
             error_msg = str(error)
-            await status_message.edit_text(
+            reporter.cancel()
+            await send_final_status(
+                status_message,
                 f"❌ **Google Drive Upload Failed**\n\n"
                 f"📁 File: {file_name}\n"
                 f"🚫 Error: {error_msg}\n\n"
@@ -234,8 +717,17 @@ async def handle_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
             logger.error(f"Google Drive upload error: {error_msg}")
         finally:
-            if os.path.exists(temp_file_path):
+            # Unblock an upload thread still waiting on data, and let it exit before
+            # the stream's memory map is closed.
+            reporter.cancel()
+            download.cancel()
+            stream.fail(RuntimeError("Download from Telegram did not complete"))
+            await asyncio.gather(upload, return_exceptions=True)
+            stream.close()
+            try:
                 os.unlink(temp_file_path)
+            except FileNotFoundError:
+                pass
             logger.info(f"Cleaned up temporary file: {temp_file_path}")
     except Exception as e:
         error_msg = str(e)
@@ -248,8 +740,6 @@ async def handle_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
 
 async def text_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not await check_authorization(update):
-        return
     await update.message.reply_text(
         "👋 Hello! I'm ready to help you upload files to Google Drive.\n\n"
         "📤 **To upload a file:**\n"
@@ -258,26 +748,81 @@ async def text_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
 # --- Telegram Bot Setup ---
+# Authorization is checked by PTB before any handler runs
+auth_filter = filters.User(user_id=AUTHORIZED_USERS) if AUTHORIZED_USERS else filters.ALL
+# Passing filters replaces CommandHandler's default update types, so restate them
+command_filter = filters.UpdateType.MESSAGES & auth_filter
 application = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
-application.add_handler(CommandHandler("start", start_command))
-application.add_handler(CommandHandler("help", help_command))
-application.add_handler(CommandHandler("status", status_command))
-application.add_handler(MessageHandler(filters.Document.ALL, handle_file))
-application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, text_handler))
-
-@app.route(f"/webhook/{TELEGRAM_BOT_TOKEN}", methods=["POST"])
-def telegram_webhook():
-    update = Update.de_json(request.get_json(force=True), application.bot)
-    application.update_queue.put_nowait(update)
-    return "OK"
-
-@app.before_first_request
-def set_webhook():
-    public_url = f"https://{os.environ['RENDER_EXTERNAL_HOSTNAME']}/webhook/{TELEGRAM_BOT_TOKEN}"
-    application.bot.set_webhook(public_url)
-    logger.info(f"Webhook set to: {public_url}")
+application.add_handler(CommandHandler("start", start_command, filters=command_filter))
+application.add_handler(CommandHandler("help", help_command, filters=command_filter))
+application.add_handler(CommandHandler("status", status_command, filters=command_filter))
+application.add_handler(MessageHandler(filters.Document.ALL & auth_filter, handle_file))
+application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND & auth_filter, text_handler))
+if AUTHORIZED_USERS:
+    application.add_handler(MessageHandler(
+        filters.UpdateType.MESSAGE
+        & (filters.COMMAND | filters.TEXT | filters.Document.ALL)
+        & ~auth_filter,
+        reject_unauthorized
+    ))
+
+WEBHOOK_PATH = f"/webhook/{TELEGRAM_BOT_TOKEN}"
+flask_asgi = WsgiToAsgi(app)
+
+async def asgi_app(scope, receive, send):
+    # Telegram updates are read and queued directly on the event loop; everything
+    # else (health checks) is served by Flask. Startup and shutdown are done in
+    # main(), so lifespan events are just acknowledged; WsgiToAsgi rejects them.
+    if scope["type"] == "lifespan":
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+    if scope["type"] == "http" and scope["method"] == "POST" and scope["path"] == WEBHOOK_PATH:
+        body = b""
+        more_body = True
+        while more_body:
+            message = await receive()
+            body += message.get("body", b"")
+            more_body = message.get("more_body", False)
+        update = Update.de_json(orjson.loads(body), application.bot)
+        await application.update_queue.put(update)
+        await send({
+            "type": "http.response.start",
+            "status": 200,
+            "headers": [(b"content-type", b"text/plain")]
+        })
+        await send({"type": "http.response.body", "body": b"OK"})
+        return
+    await flask_asgi(scope, receive, send)
+
+async def main():
+    # The web server and the bot share this one event loop. Without a public
+    # hostname (e.g. running locally) updates are fetched by polling instead.
+    await application.initialize()
+    await application.start()
+    edits = asyncio.create_task(edit_worker())
+    hostname = os.environ.get("RENDER_EXTERNAL_HOSTNAME")
+    if hostname:
+        public_url = f"https://{hostname}{WEBHOOK_PATH}"
+        await application.bot.set_webhook(public_url)
+        logger.info(f"Webhook set to: {public_url}")
+    else:
+        await application.updater.start_polling()
+        logger.info("No RENDER_EXTERNAL_HOSTNAME set, polling for updates")
+    config = Config()
+    config.bind = [f"0.0.0.0:{int(os.environ.get('PORT', 8000))}"]
+    try:
+        await serve(asgi_app, config)
+    finally:
+        edits.cancel()
+        if application.updater.running:
+            await application.updater.stop()
+        await application.stop()
+        await application.shutdown()
 
 if __name__ == "__main__":
-    PORT = int(os.environ.get('PORT', 8000))
-    app.run(host="0.0.0.0", port=PORT)
-        
+    asyncio.run(main())